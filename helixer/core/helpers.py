@@ -122,30 +122,61 @@ def find_confident_single_class_regions(pred_chunk, pad=5):
 
 def divvy_by_confidence(one_class_chunk, step_key, pad=5, stability_threshold=0.1):
     """breaks down contiguous 1-class region to pre-hints with semi-consistent confidence"""
+    main_class, starts, ends, confidences = divvy_by_confidence_arrays(one_class_chunk, step_key, pad=pad,
+                                                                       stability_threshold=stability_threshold)
+    for start, end, confidence in zip(starts, ends, confidences):
+        yield {'category': main_class,
+               'start': start,
+               'end': end,
+               'confidence': confidence}
+
+
+def divvy_by_confidence_arrays(one_class_chunk, step_key, pad=5, stability_threshold=0.1):
+    """as divvy_by_confidence, but returns category and arrays of all pre-hint starts, ends and confidences at once"""
     main_class = np.argmax(one_class_chunk[0])
     min_step, max_size = step_key[main_class]
-    diffs = np.abs(one_class_chunk[:-1, main_class] - one_class_chunk[1:, main_class])
-    cumulative_diffs = np.cumsum(diffs)
+    main_confidence = one_class_chunk[:, main_class]
+    # cumulative absolute diffs between neighbours, all in one buffer
+    cumulative_diffs = np.empty(main_confidence.shape[0] - 1, dtype=main_confidence.dtype)
+    np.subtract(main_confidence[:-1], main_confidence[1:], out=cumulative_diffs)
+    np.abs(cumulative_diffs, out=cumulative_diffs)
+    np.cumsum(cumulative_diffs, out=cumulative_diffs)
     # we start after padding (and end before), not necessarily at 0 nor sequence end
+    padded_seq_end = one_class_chunk.shape[0] - pad
+    if padded_seq_end <= pad:
+        empty = np.zeros(0, dtype=np.int64)
+        return main_class, empty, empty, np.zeros(0, dtype=one_class_chunk.dtype)
+    # all possible ends, every min_step from the padding on, and the padded sequence end itself
+    candidate_ends = np.minimum(np.arange(pad + min_step, padded_seq_end + min_step, min_step), padded_seq_end)
+    cdiffs_at_candidates = cumulative_diffs[candidate_ends]
+    last_candidate = candidate_ends.shape[0] - 1
+
+    starts, ends = [], []
     cdiff_at_last_yield = cumulative_diffs[pad]
     end_of_last_yield = pad
-    padded_seq_end = one_class_chunk.shape[0] - pad
-    for i in range(pad, padded_seq_end, min_step):
-        end = min(i + min_step, padded_seq_end)
+    i = 0
+    while i <= last_candidate:
         # if the total observed diffs since yield have passed the threshold, yield again
         # thus where confidence is volatile one gets small chunks, and for continuous predictions
         # one gets large (probably max_size) chunks (saves gff size & there's little gain in breaking down)
-        if cumulative_diffs[end] - cdiff_at_last_yield > stability_threshold or \
-                end - end_of_last_yield > max_size or \
-                end == padded_seq_end:
-            start = end_of_last_yield
-            yield {'category': main_class,
-                   'start': start,
-                   'end': end,
-                   'confidence': np.mean(one_class_chunk[start:end, main_class])}
-            # reset trackers
-            end_of_last_yield = end
-            cdiff_at_last_yield = cumulative_diffs[end]
+        # the first end beyond max_size (or the final end) is the furthest we can go, so only search up to there
+        furthest = min(np.searchsorted(candidate_ends, end_of_last_yield + max_size, side='right'), last_candidate)
+        passed = np.flatnonzero(cdiffs_at_candidates[i:furthest] - cdiff_at_last_yield > stability_threshold)
+        i = i + passed[0] if passed.shape[0] else furthest
+        starts.append(end_of_last_yield)
+        ends.append(candidate_ends[i])
+        # reset trackers
+        end_of_last_yield = candidate_ends[i]
+        cdiff_at_last_yield = cdiffs_at_candidates[i]
+        i += 1
+
+    # mean confidence of every pre-hint at once, from the cumulative sum of the main class
+    cumulative_conf = np.zeros(one_class_chunk.shape[0] + 1, dtype=np.float64)
+    np.cumsum(main_confidence, out=cumulative_conf[1:])
+    starts = np.array(starts)
+    ends = np.array(ends)
+    confidences = ((cumulative_conf[ends] - cumulative_conf[starts]) / (ends - starts)).astype(one_class_chunk.dtype)
+    return main_class, starts, ends, confidences
 
 def file_stem(path):
     """Returns the file name without extension"""
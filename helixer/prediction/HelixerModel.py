@@ -10,6 +10,8 @@ except ImportError:
     pass
 import time
 import glob
+import queue
+import threading
 import h5py
 import numcodecs
 import argparse
@@ -18,7 +20,6 @@ from importlib.metadata import version
 import subprocess
 import numpy as np
 import tensorflow as tf
-from sklearn.utils import shuffle
 from pprint import pprint
 from termcolor import colored
 from terminaltables import AsciiTable
@@ -28,7 +29,7 @@ from tensorflow.keras import optimizers
 from tensorflow.keras import backend as K
 from tensorflow.keras.models import load_model, Model
 from tensorflow.keras.utils import Sequence
-from tensorflow.keras.layers import Input
+from tensorflow.keras.layers import Input, Lambda
 from tensorflow_addons.optimizers import AdamW
 
 from helixer.prediction.Metrics import Metrics
@@ -118,15 +119,6 @@ class ConfusionMatrixTrain(Callback):
             nni.report_final_result(self.best_val_genic_f1)
 
 
-class PreshuffleCallback(Callback):
-    def __init__(self, train_generator):
-        self.train_generator = train_generator
-
-    def on_epoch_begin(self, epoch, logs=None):
-        if self.train_generator.shuffle:
-            self.train_generator.shuffle_data()
-
-
 class HelixerSequence(Sequence):
     def __init__(self, model, h5_files, mode, batch_size, shuffle):
         assert mode in ['train', 'val', 'test']
@@ -138,7 +130,8 @@ class HelixerSequence(Sequence):
         self._cp_into_namespace(['float_precision', 'class_weights', 'transition_weights', 'input_coverage',
                                  'coverage_count', 'coverage_norm', 'overlap', 'overlap_offset', 'core_length',
                                  'stretch_transition_weights', 'coverage_weights', 'coverage_offset',
-                                 'no_utrs', 'predict_phase', 'load_predictions', 'only_predictions', 'debug'])
+                                 'no_utrs', 'predict_phase', 'load_predictions', 'only_predictions', 'debug',
+                                 'shuffle_seed'])
 
         if self.mode == 'test':
             assert len(self.h5_files) == 1, "predictions and eval should be applied to individual files only"
@@ -197,6 +190,11 @@ class HelixerSequence(Sequence):
 
         self.n_seqs = len(self.data_lists[0])
         print(f'setting self.n_seqs to {self.n_seqs}, bc that is len of {self.data_list_names[0]}')
+        # order in which the loaded samples are batched, shuffling permutes this instead of all the data lists
+        self.usable_idx = np.arange(self.n_seqs, dtype=np.int64)
+        self._rng = np.random.default_rng(self.shuffle_seed)
+        if self.shuffle:
+            self.shuffle_data()
 
         if self.mode == "test":
             if self.class_weights is not None:
@@ -222,19 +220,20 @@ class HelixerSequence(Sequence):
             n_seqs = x_dset.shape[0]
 
         if self.mode == "train" or self.mode == 'val':
-            mask = np.logical_and(h5_file['data/is_annotated'],
-                                  h5_file['data/err_samples'])
-            n_masked = x_dset.shape[0] - np.sum(mask)
+            mask = np.logical_and(h5_file['data/is_annotated'][:],
+                                  h5_file['data/err_samples'][:])
+            n_masked = x_dset.shape[0] - np.count_nonzero(mask)
             print(f'\nmasking {n_masked} completely un-annotated or completely erroneous sequences')
 
         else:
             mask = np.ones(h5_file['data/X'].shape[0], dtype=bool)
             n_masked = 0
 
-        # load at most 2000 uncompressed samples at a time in memory
-        max_at_once = min(2000, n_seqs)
         for name, data_list in zip(self.data_list_names, self.data_lists):
             start_time_dset = time.time()
+            # load ~2000 uncompressed samples at a time in memory, as whole h5 chunks along the sample axis
+            sample_axis = 1 if name == 'data/predictions' else 0
+            max_at_once = HelixerSequence._chunk_aligned_n_samples(h5_file[name], n_seqs, sample_axis)
             for offset in range(0, n_seqs, max_at_once):
                 step_mask = mask[offset:offset + max_at_once]
                 if name == 'data/predictions':
@@ -247,6 +246,12 @@ class HelixerSequence(Sequence):
             print(f'Data loading of {n_seqs - n_masked} (total so far {len(data_list)}) samples of {name} '
                   f'into memory took {time.time() - start_time_dset:.2f} secs')
 
+    @staticmethod
+    def _chunk_aligned_n_samples(dset, n_seqs, sample_axis=0, target=2000):
+        """number of samples to read at once from dset, rounded to full h5 chunks so no chunk is decompressed twice"""
+        samples_per_chunk = dset.chunks[sample_axis] if dset.chunks is not None else 1
+        return min(max(target // samples_per_chunk, 1) * samples_per_chunk, n_seqs)
+
     @staticmethod
     def _zero_out_utrs(y):
         # merge UTR and IG labels and zero out the UTR column
@@ -256,9 +261,14 @@ class HelixerSequence(Sequence):
 
     def shuffle_data(self):
         start_time = time.time()
-        self.data_lists = shuffle(*self.data_lists)
+        self._rng.shuffle(self.usable_idx)
         print(f'Reshuffled {self.mode} data in {time.time() - start_time:.2f} secs')
 
+    def on_epoch_end(self):
+        # keras calls this between epochs, when no batch of the old order is still being fetched
+        if self.shuffle:
+            self.shuffle_data()
+
     def _cp_into_namespace(self, names):
         """Moves class properties from self.model into this class for brevity"""
         for name in names:
@@ -286,6 +296,9 @@ class HelixerSequence(Sequence):
                 decoded = np.stack(decoded_list, axis=0)
                 if self.overlap and name == 'data/X':
                     decoded = self.ol_helper.make_input(batch_idx, decoded)
+                if name == 'data/X':
+                    # match the model's input dtype here (in the loading worker), so keras doesn't have to convert
+                    decoded = decoded.astype(self.float_precision, copy=False)
 
                 batch.append(decoded)
 
@@ -297,8 +310,8 @@ class HelixerSequence(Sequence):
         if self.overlap:
             h5_indices = self.ol_helper.h5_indices_of_batch(batch_idx)
         else:
-            end = min(self.n_seqs, (batch_idx + 1) * self.batch_size)
-            h5_indices = np.arange(batch_idx * self.batch_size, end)
+            # copy, so the batch never sees a (re)shuffle of usable_idx halfway through
+            h5_indices = self.usable_idx[batch_idx * self.batch_size:(batch_idx + 1) * self.batch_size].copy()
 
         return self._decode_one(name, h5_indices)
 
@@ -317,12 +330,17 @@ class HelixerSequence(Sequence):
         method = self.coverage_norm
         if method is None:
             return x
-        elif method == 'log':
-            return np.log(x + 1.1)
+        # x is an (integer, read only) decoded buffer, so make one float working copy and normalize that in place
+        # (float64, as computed before, float32 would change some log values by one float16 unit)
+        x = x.astype(np.float64)
+        if method == 'log':
+            x += 1.1
+            np.log(x, out=x)
         elif method == 'linear':
-            return x / 100
+            x /= 100
         else:
             raise ValueError(f'unrecognized method: {method} for normalizing coverage data')
+        return x
 
     def _update_sw_with_transition_weights(self):
         pass
@@ -410,6 +428,41 @@ class HelixerSequence(Sequence):
         dilated_rf[i, j] = np.maximum(reshaped_sw_t[i, j], 1)
         return dilated_rf
 
+    def iter_prefetched(self, max_queue_size=4):
+        """yields all batches once and in order, while the next ones are already loaded in a background thread"""
+        # so the decompressing and preprocessing of batches overlaps with e.g. predicting on the GPU
+        # the producer stops after one pass (unlike keras' enqueuers, which start loading the next epoch)
+        batches = queue.Queue(maxsize=max_queue_size)
+        stop = threading.Event()
+
+        def produce():
+            for idx in range(len(self)):
+                try:
+                    item = (self[idx], None)
+                except Exception as e:
+                    item = (None, e)
+                # don't block forever on a full queue if the consumer stopped early
+                while not stop.is_set():
+                    try:
+                        batches.put(item, timeout=1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set() or item[1] is not None:
+                    return
+
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            for _ in range(len(self)):
+                batch, error = batches.get()
+                if error is not None:
+                    raise error
+                yield batch
+        finally:
+            stop.set()
+            producer.join()
+
     def __len__(self):
         """how many batches in epoch"""
         if self.debug:
@@ -475,6 +528,9 @@ class HelixerSequence(Sequence):
                     coverage_scores = np.mean(coverage_scores, axis=2)
                     sw = np.multiply(coverage_scores, sw)
 
+            if not self.only_predictions:
+                sw = sw.astype(self.float_precision, copy=False)
+
             if self.predict_phase and not self.only_predictions:
                 y_phase = self._mk_timestep_pools_class_last(phases)
                 y = [y, y_phase]
@@ -511,6 +567,9 @@ class HelixerModel(ABC):
         self.parser.add_argument('--predict-phase', action='store_true')
         self.parser.add_argument('--load-predictions', action='store_true', help=argparse.SUPPRESS)  # bc no models that can use this are available
         self.parser.add_argument('--resume-training', action='store_true')
+        self.parser.add_argument('--shuffle-seed', type=int, default=None,
+                                 help='seed for shuffling the training data each epoch, for reproducible sample order '
+                                      '(default: random)')
         # testing / predicting
         self.parser.add_argument('-l', '--load-model-path', type=str, default='')
         self.parser.add_argument('-t', '--test-data', type=str, default='')
@@ -624,8 +683,7 @@ class HelixerModel(ABC):
         callbacks = [ConfusionMatrixTrain(self.save_model_path, train_generator, self.gen_validation_data(),
                                           self.large_eval_folder, self.patience, calc_H=self.calculate_uncertainty,
                                           report_to_nni=self.nni, check_every_nth_batch=self.check_every_nth_batch,
-                                          save_every_check=self.save_every_check),
-                     PreshuffleCallback(train_generator)]
+                                          save_every_check=self.save_every_check)]
         return callbacks
 
     def set_resources(self):
@@ -744,8 +802,8 @@ class HelixerModel(ABC):
             sum_n_correct = 0
             for h5_file in h5_files:
                 if 'err_samples' in h5_file['/data'].keys():
-                    err_samples = np.array(h5_file['/data/err_samples'])
-                    n_correct = np.count_nonzero(err_samples == False)
+                    err_samples = h5_file['/data/err_samples'][:]
+                    n_correct = err_samples.size - np.count_nonzero(err_samples)
                     if n_correct == 0:
                         print('WARNING: no fully correct sample found')
                 else:
@@ -758,8 +816,8 @@ class HelixerModel(ABC):
             sum_n_fully_ig = 0
             for h5_file in h5_files:
                 if 'fully_intergenic_samples' in h5_file['/data'].keys():
-                    ic_samples = np.array(h5_file['/data/fully_intergenic_samples'])
-                    n_fully_ig = np.count_nonzero(ic_samples == True)
+                    ic_samples = h5_file['/data/fully_intergenic_samples'][:]
+                    n_fully_ig = np.count_nonzero(ic_samples)
                     if n_fully_ig == 0:
                         print('WARNING: no fully intergenic samples found')
                 else:
@@ -825,16 +883,17 @@ class HelixerModel(ABC):
     def _make_predictions(self, model):
         # loop through batches and continuously expand output dataset as everything might
         # not fit in memory
-        pred_out = h5py.File(self.prediction_output_path, 'w')
+        pred_out = h5py.File(self.prediction_output_path, 'w', rdcc_nbytes=64 * 2 ** 20)
         test_sequence = self.gen_test_data()
+        padded_buffers = {}
 
-        for batch_index in range(len(test_sequence)):
+        for batch_index, batch in enumerate(test_sequence.iter_prefetched()):
             if self.verbose:
                 print(batch_index, '/', len(test_sequence), end='\r')
             if not self.only_predictions:
-                input_data = test_sequence[batch_index][0]
+                input_data = batch[0]
             else:
-                input_data = test_sequence[batch_index]
+                input_data = batch
             try:
                 predictions = model.predict_on_batch(input_data)
             except Exception as e:
@@ -866,9 +925,17 @@ class HelixerModel(ABC):
                     # add 0-padding if needed
                     n_removed = self.shape_test[1] - pred_dset.shape[1]
                     if n_removed > 0:
-                        zero_padding = np.zeros((pred_dset.shape[0], n_removed, pred_dset.shape[2]),
-                                                dtype=pred_dset.dtype)
-                        pred_dset = np.concatenate((pred_dset, zero_padding), axis=1)
+                        # copy into a zero initialized buffer of full length instead of concatenating padding,
+                        # the buffer is reused for all batches as the padded end is never written to
+                        padded = padded_buffers.get(dset_name)
+                        if padded is None or padded.shape[0] < pred_dset.shape[0]:
+                            # without overlapping, cast to the float16 written to disk right here as well
+                            buffer_dtype = pred_dset.dtype if self.overlap else np.float16
+                            padded = np.zeros((pred_dset.shape[0], self.shape_test[1], label_dim), dtype=buffer_dtype)
+                            padded_buffers[dset_name] = padded
+                        padded = padded[:pred_dset.shape[0]]
+                        padded[:, :pred_dset.shape[1]] = pred_dset
+                        pred_dset = padded
                 else:
                     n_removed = 0  # just to avoid crashing with Unbound Local Error setting attrs for dCNN
 
@@ -876,13 +943,16 @@ class HelixerModel(ABC):
                     pred_dset = test_sequence.ol_helper.overlap_predictions(batch_index, pred_dset)
 
                 # prepare h5 dataset and save the predictions to disk
-                pred_dset = pred_dset.astype(np.float16)
+                pred_dset = pred_dset.astype(np.float16, copy=False)
                 if batch_index == 0:
                     old_len = 0
+                    # aim for ~1MB chunks along the sample axis, instead of one (smaller or larger) chunk per sample
+                    bytes_per_sample = int(np.prod(pred_dset.shape[1:])) * pred_dset.itemsize
+                    samples_per_chunk = max(1, 2 ** 20 // bytes_per_sample)
                     pred_out.create_dataset(dset_name,
                                             data=pred_dset,
                                             maxshape=(None,) + pred_dset.shape[1:],
-                                            chunks=(1,) + pred_dset.shape[1:],
+                                            chunks=(samples_per_chunk,) + pred_dset.shape[1:],
                                             dtype='float16',
                                             compression=self.compression,
                                             shuffle=True)
@@ -903,6 +973,12 @@ class HelixerModel(ABC):
         pred_out.close()
         h5_model.close()
 
+    @staticmethod
+    def _with_float16_outputs(model):
+        """wraps model so predictions are cast to float16 in the graph, i.e. on the GPU before copying them back"""
+        outputs = [Lambda(lambda t: K.cast(t, 'float16'))(output) for output in model.outputs]
+        return Model(model.input, outputs if len(outputs) > 1 else outputs[0])
+
     def _print_model_info(self, model):
         pwd = os.getcwd()
         os.chdir(os.path.dirname(__file__))
@@ -949,6 +1025,10 @@ class HelixerModel(ABC):
 
                 model = self.insert_coverage_before_hat(oldmodel, dense_at)
                 model.load_weights(self.load_model_path)
+            if not self.eval and not self.overlap:
+                # overlapping averages the raw predictions, otherwise they go straight to disk as float16,
+                # wrapped here so the wrapper is built in the same (possibly distributed) scope as the model
+                model = HelixerModel._with_float16_outputs(model)
             return model
 
         self.set_resources()
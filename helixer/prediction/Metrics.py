@@ -270,10 +270,8 @@ class Metrics:
         return y_true, y_pred, sw
 
     def calculate_metrics(self, model):
-        for batch_idx in range(len(self.generator)):
+        for batch_idx, inputs in enumerate(self.generator.iter_prefetched()):
             print(batch_idx, '/', len(self.generator) - 1, end="\r")
-
-            inputs = self.generator[batch_idx]
             if len(inputs) == 2 and type(inputs[0]) is list:
                 mode = 'dialated_conv'
                 (X, sw), y_true = inputs
@@ -1271,6 +1271,35 @@ def test_predictions_realdata():
                     assert np.all(np.argmax(inputpred, axis=1) == pre_hint['category'])
 
 
+def test_divvy_by_confidence_arrays():
+    """test pre-hint boundaries and confidences against the values of the original step by step implementation"""
+    hint_step_key = [(100, 10_000), (10, 500), (10, 500), (10, 500)]
+    # volatile confidence mid-way gives min_step sized pre-hints, stable confidence before and after large ones
+    one_class_chunk = np.full(fill_value=0., shape=(1000, 4), dtype=np.float16)
+    one_class_chunk[:, 2] = 1.
+    one_class_chunk[400:500, 2] = np.tile([0.9, 0.8], 50)
+    category, starts, ends, confidences = helpers.divvy_by_confidence_arrays(one_class_chunk, hint_step_key)
+    assert category == 2
+    assert list(starts) == [5] + list(range(405, 506, 10))
+    assert list(ends) == list(range(405, 506, 10)) + [995]
+    assert np.array_equal(confidences, np.array([0.998] + [0.8496] * 9 + [0.92, 1.], dtype=np.float16))
+
+    # stable confidence for longer than max_size (500) gets cut at the first step beyond it
+    one_class_chunk = np.full(fill_value=0., shape=(1300, 4), dtype=np.float16)
+    one_class_chunk[:, 1] = 0.97
+    one_class_chunk[1000:1010, 1] = 0.8
+    category, starts, ends, confidences = helpers.divvy_by_confidence_arrays(one_class_chunk, hint_step_key)
+    assert category == 1
+    assert list(starts) == [5, 515, 1005, 1015]
+    assert list(ends) == [515, 1005, 1015, 1295]
+    assert np.array_equal(confidences, np.array([0.97, 0.9683, 0.885, 0.97], dtype=np.float16))
+
+    # and the generator version yields the same pre-hints
+    pre_hints = list(helpers.divvy_by_confidence(one_class_chunk, hint_step_key))
+    assert [(h['category'], h['start'], h['end']) for h in pre_hints] == [(1, 5, 515), (1, 515, 1005),
+                                                                           (1, 1005, 1015), (1, 1015, 1295)]
+
+
 # overlapping
 def test_ol_length_in_matches_out_sub_batch():
     """test that predictions length matches input length, after sliding window preds and overlapping, in sub batch"""
@@ -1,96 +1,112 @@
 """converts Helixer's output predictions into AUGUSTUS compatible hints"""
 import argparse
 import h5py
+from multiprocessing import Pool
 from helixer.core.helpers import find_confident_single_class_regions, get_contiguous_ranges, read_in_chunks, \
-    divvy_by_confidence
+    divvy_by_confidence_arrays
 
 
 HINTS = ['irpart', 'UTRpart', 'CDSpart', 'intronpart']
+# seqid, source, feature, start, end, score, strand, phase, attribute
+# Helixer has no phase info, and source=H just says from Helixer (must be specified in extrinsic.cfg to match)
+GFF_ROW = '%s\tHelixer\t%s\t%d\t%d\t%s\t%s\t.\tsource=H\n'
+WRITE_EVERY = 10_000  # rows
+# h5 files opened once per (worker) process, see open_h5s
+H5_DATA = None
+H5_PREDS = None
 
 
-def start_end_strand(contiguous_bit, pred_chunk_start, one_category_start, pre_hint):
-    """convert coordinates from relative to absolute and pythonic, i.e. [,) from 0, to gff, i.e. [,] from 1"""
-    if contiguous_bit['is_plus_strand']:
-        # start as a combined coordinate
-        # hint rel. to one_class_chunk  + one_class_chunk rel. to pred_chunk + pred_chunk rel to seq.
-        absolute_start = pred_chunk_start + one_category_start + pre_hint['start']
-        # similar for end
-        absolute_end = pred_chunk_start + one_category_start + pre_hint['end']
-        # both inclusive, both counting from 1
-        gff_start = absolute_start + 1
-        gff_end = absolute_end  # +1 to count from 1, canceled by -1 for inclusive from exclusive
-        strand = '+'
-    else:
-        # the orientation of pred_chunk and one_class_chunk are flipped relative to genome, thus '-'
-        absolute_start = pred_chunk_start - one_category_start - pre_hint['start']
-        absolute_end = pred_chunk_start - one_category_start - pre_hint['end']
-        # both inclusive, both counting from 1, start and end flipped
-        gff_start = absolute_start + 1
-        gff_end = absolute_end
-        gff_start, gff_end = gff_end, gff_start
-        strand = '-'
-    return gff_start, gff_end, strand
+def open_h5s(h5_data, predictions):
+    """opens the h5 files on first use in this process (not in a pool initializer, which is retried forever on error)"""
+    global H5_DATA, H5_PREDS
+    if H5_DATA is None:
+        H5_DATA = h5py.File(h5_data, mode='r')
+    if H5_PREDS is None:
+        H5_PREDS = h5py.File(predictions, mode='r')
 
 
-def write_to_gff(hints_handle, fw_and_reverse):
-    fw_and_reverse = sorted(fw_and_reverse, key=lambda x: x[3])  # sort by start (within seq)
-    for gff_fields in fw_and_reverse:
-        gff_fields = [str(x) for x in gff_fields]
-        gff_entry = '\t'.join(gff_fields)
-        hints_handle.write(gff_entry + '\n')
+def close_h5s():
+    for h5 in (H5_DATA, H5_PREDS):
+        if h5 is not None:
+            h5.close()
 
 
-def main(arguments):
-    # read in big chunk of h5s
-    data = h5py.File(arguments.h5_data, mode='r')
-    preds = h5py.File(arguments.predictions, mode='r')
-    # open output file
-    hints_handle = open(arguments.hints_out, 'w')
+def write_to_gff(hints_handle, fw_and_reverse):
+    fw_and_reverse = sorted(fw_and_reverse, key=lambda x: x[0])  # sort by start (within seq)
+    for i in range(0, len(fw_and_reverse), WRITE_EVERY):
+        hints_handle.writelines([gff_entry for _, gff_entry in fw_and_reverse[i:i + WRITE_EVERY]])
 
+
+def hints_of_contiguous_bit(mapargs):
+    """returns (gff start, gff entry) of all hints on one contiguous bit, i.e. one strand of one sequence"""
+    contiguous_bit, arguments = mapargs
+    open_h5s(arguments.h5_data, arguments.predictions)
     # setup parameterized step/size for easy parsing based on prediction argmax
     ir_step_and_max = (arguments.step_irpart, arguments.max_irpart_size)
     genic_step_and_max = (arguments.step_genicpart, arguments.max_genicpart_size)
     hint_step_key = (ir_step_and_max, genic_step_and_max, genic_step_and_max, genic_step_and_max)
 
-    # step through
+    hints = []
+    sequence = contiguous_bit['seqid'].decode()
+    is_plus_strand = contiguous_bit['is_plus_strand']
+    strand = '+' if is_plus_strand else '-'
+    for pred_chunk, start, end in read_in_chunks(H5_PREDS, H5_DATA, contiguous_bit['start_i'],
+                                                 contiguous_bit['end_i']):
+        # break into pieces anywhere where the confidence drops or the category switches
+        for start_conf, end_conf in find_confident_single_class_regions(pred_chunk, arguments.pad):
+            one_class_chunk = pred_chunk[start_conf:end_conf]
+            # pad and break further, down to min size confidence is volatile or up to max if stable
+            # use average prediction confidence as score
+            category, hint_starts, hint_ends, confidences = divvy_by_confidence_arrays(
+                one_class_chunk, hint_step_key, pad=arguments.pad,
+                stability_threshold=arguments.stability_threshold)
+            feature = HINTS[category]
+            # convert coordinates from relative to absolute and pythonic, i.e. [,) from 0, to gff, i.e. [,] from 1
+            # hint rel. to one_class_chunk  + one_class_chunk rel. to pred_chunk + pred_chunk rel to seq.
+            if is_plus_strand:
+                # start +1 to count from 1, for end +1 to count from 1 is canceled by -1 for inclusive
+                gff_starts = start + start_conf + hint_starts + 1
+                gff_ends = start + start_conf + hint_ends
+            else:
+                # the orientation of pred_chunk and one_class_chunk are flipped relative to genome, thus '-'
+                # both inclusive, both counting from 1, start and end flipped
+                gff_starts = start - start_conf - hint_ends
+                gff_ends = start - start_conf - hint_starts + 1
+            hints.extend([(gff_start, GFF_ROW % (sequence, feature, gff_start, gff_end, score, strand))
+                          for gff_start, gff_end, score in zip(gff_starts.tolist(), gff_ends.tolist(), confidences)])
+    return hints
+
+
+def write_hints(hints_handle, contiguous_bits, hints_by_bit):
     fw_and_reverse = []
     previous_seq = None
-    for contiguous_bit in get_contiguous_ranges(h5=data):
+    for contiguous_bit, hints in zip(contiguous_bits, hints_by_bit):
         # sort fw & rev hints on one sequence together and write to file
         if contiguous_bit['seqid'] != previous_seq and previous_seq is not None:
             write_to_gff(hints_handle, fw_and_reverse)
             fw_and_reverse = []
 
         previous_seq = contiguous_bit['seqid']
-        for pred_chunk, start, end in read_in_chunks(preds, data, contiguous_bit['start_i'], contiguous_bit['end_i']):
-            # break into pieces anywhere where the confidence drops or the category switches
-            for start_conf, end_conf in find_confident_single_class_regions(pred_chunk, arguments.pad):
-                one_class_chunk = pred_chunk[start_conf:end_conf]
-                # pad and break further, down to min size confidence is volatile or up to max if stable
-                # use average prediction confidence as score
-                for pre_hint in divvy_by_confidence(one_class_chunk, hint_step_key, pad=arguments.pad,
-                                                    stability_threshold=arguments.stability_threshold):
-                    # convert to gff entry & write
-                    # gff fields
-                    sequence = contiguous_bit['seqid'].decode()
-                    source = 'Helixer'
-                    feature = HINTS[pre_hint['category']]
-                    # resolve all relative coordinates and convert to gff
-                    gff_start, gff_end, strand = start_end_strand(contiguous_bit=contiguous_bit,
-                                                                  pred_chunk_start=start,
-                                                                  one_category_start=start_conf,
-                                                                  pre_hint=pre_hint)
-                    score = pre_hint['confidence']
-                    phase = '.'   # Helixer has no phase info
-                    attribute = 'source=H'   # just to say from Helixer, must be specified in extrinsic.cfg to match
-                    gff_fields = (sequence, source, feature, gff_start, gff_end, score, strand, phase, attribute)
-                    fw_and_reverse.append(gff_fields)
+        fw_and_reverse.extend(hints)
 
     write_to_gff(hints_handle, fw_and_reverse)  # write the very last sequence
 
-    hints_handle.close()
-    data.close()
-    preds.close()
+
+def main(arguments):
+    with h5py.File(arguments.h5_data, mode='r') as data:
+        contiguous_bits = list(get_contiguous_ranges(h5=data))
+
+    # process contiguous bits in parallel (each worker with its own h5 handles), but collect & write them in order
+    mapargs = [(contiguous_bit, arguments) for contiguous_bit in contiguous_bits]
+    with open(arguments.hints_out, 'w', buffering=1 << 20) as hints_handle:
+        if arguments.threads > 1:
+            with Pool(arguments.threads) as p:
+                write_hints(hints_handle, contiguous_bits, p.imap(hints_of_contiguous_bit, mapargs))
+        else:
+            try:
+                write_hints(hints_handle, contiguous_bits, map(hints_of_contiguous_bit, mapargs))
+            finally:
+                close_h5s()
 
 
 if __name__ == "__main__":
@@ -106,5 +122,8 @@ if __name__ == "__main__":
     parser.add_argument('--stability-threshold', default=0.1, type=float,
                         help='sets hint size by changes in prediction confidence, set high for few hints (push towards '
                              'max-size) and low for many hints (push towards step size)')
+    parser.add_argument('--threads', default=8, type=int,
+                        help='how many contiguous bits (strands of sequences) to process in parallel, '
+                             'set to a value <= 1 to not use multiprocessing')
     args = parser.parse_args()
     main(args)